@@ -0,0 +1,212 @@
+# app/checkpoint.py
+"""
+PARDUMP/PARINIT 기반 warm-start 확산 계산
+
+같은 EMITIMES·격자·SETUP·기상으로 run_hours만 늘려 재실행하는 경우,
+이전 실행 끝 시각의 입자 덤프(PARDUMP)에서 이어서 늘어난 구간만 계산한다.
+  ckpt/<key>/index.json = {"chain_start": ..., "segments": [{start, end, cdump, pardump, met}, ...]}
+  - key: EMITIMES + 격자 중심 + SETUP 템플릿 + 체인 시작시각
+  - met: 구간 계산 당시 기상 파일 크기와 그 크기까지의 전체 해시
+         → 파일 뒤에 새 시간이 덧붙는 것은 허용, 기존 바이트가 바뀌면 그 구간부터 무효
+  - 체인 단위 파일 잠금(ckpt/<key>.lock, 삭제하지 않음), 구간마다 별도 작업 폴더(run_<tag>)
+  - 기상이 모자라 hycs_std가 일찍 끝나면 실제 도달 시각까지만 구간으로 기록
+  - CKPT_RETAIN_HOURS 동안 안 쓰인 체인은 삭제
+"""
+from __future__ import annotations
+import os
+import json
+import time
+import shutil
+import hashlib
+import struct
+from math import gcd
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+
+from .simulate import (
+    WORK_ROOT, MET_DIR,
+    emittimes_text,
+    setup_base_text,
+    write_emittimes_from_entries,
+    write_control_conc,
+    write_setup_cfg,
+    run_concentration,
+    merge_cdumps,
+    cdump_end_utc,
+    _fortran_records,
+)
+from .locks import file_lock
+
+CKPT_DIR     = WORK_ROOT / "ckpt"
+DUMP_HOURS   = int(os.getenv("PARDUMP_HOURS", "1"))       # 입자 덤프 간격(시간)
+RETAIN_HOURS = float(os.getenv("CKPT_RETAIN_HOURS", "72"))  # 미사용 체인 보관 시간
+_CHUNK       = 4 * 1024 * 1024
+
+_digest_cache: dict[tuple, str] = {}   # (path, st_size, st_mtime_ns, prefix) -> sha1
+
+def _prefix_digest(p: Path, size: int) -> str:
+    """파일 앞 size 바이트의 sha1 (파일이 안 바뀌었으면 캐시 사용)"""
+    st = p.stat()
+    ck = (str(p), st.st_size, st.st_mtime_ns, size)
+    if ck not in _digest_cache:
+        h = hashlib.sha1()
+        with open(p, "rb") as f:
+            left = size
+            while left > 0:
+                buf = f.read(min(_CHUNK, left))
+                if not buf:
+                    break
+                h.update(buf)
+                left -= len(buf)
+        _digest_cache[ck] = h.hexdigest()
+    return _digest_cache[ck]
+
+def _met_state() -> dict[str, list]:
+    state = {}
+    for p in sorted(MET_DIR.glob("*.BIN")):
+        size = p.stat().st_size
+        state[p.name] = [size, _prefix_digest(p, size)]
+    return state
+
+def _met_still_valid(recorded: dict[str, list]) -> bool:
+    """기록 당시 내용이 그대로이고 뒤에 덧붙기만 했는지"""
+    for name, (size, digest) in recorded.items():
+        p = MET_DIR / name
+        if not p.exists() or p.stat().st_size < size or _prefix_digest(p, size) != digest:
+            return False
+    return True
+
+def _chain_key(emit_text: str, start_utc: datetime, grid_center) -> str:
+    h = hashlib.sha1()
+    h.update(emit_text.encode())
+    h.update(setup_base_text().encode())
+    h.update(f"{start_utc:%Y%m%d%H}|{grid_center}".encode())
+    return h.hexdigest()[:16]
+
+def _load_index(kdir: Path, start_utc: datetime) -> dict:
+    idx = kdir / "index.json"
+    if idx.exists():
+        return json.loads(idx.read_text())
+    return {"chain_start": start_utc.isoformat(), "segments": []}
+
+def _drop(seg: dict):
+    for k in ("cdump", "pardump"):
+        try: Path(seg[k]).unlink()
+        except FileNotFoundError: pass
+
+def _lock_path(kdir: Path) -> Path:
+    """체인 잠금 파일 — 체인 폴더 밖에 두어 삭제(eviction) 후에도 같은 inode 유지"""
+    return CKPT_DIR / f"{kdir.name}.lock"
+
+def _pardump_times(path: Path) -> list[datetime]:
+    """
+    PARDUMP의 덤프 시각 목록. 덤프마다 헤더(KPT, NUMPUF, KGPT, 년, 월, 일, 시, 분) 뒤에
+    입자가 있으면(KPT>0) 질량/위치/속성 레코드 3개가 이어짐
+    """
+    times = []
+    recs = _fortran_records(path)
+    try:
+        for rec in recs:
+            kpt, _puf, _gpt, y, m, d, h, mi = struct.unpack_from(">8i", rec)
+            times.append(datetime(y + 2000 if y < 100 else y, m, d, h, mi, tzinfo=timezone.utc))
+            if kpt > 0:
+                for _ in range(3):
+                    next(recs)
+    except (struct.error, ValueError, StopIteration) as e:
+        raise RuntimeError(f"Cannot parse PARDUMP {path}: {e}")
+    return times
+
+def _evict_stale(keep: Path):
+    """RETAIN_HOURS 넘게 안 쓰인 체인 삭제 (사용 중인 체인은 잠금으로 건너뜀)"""
+    if not CKPT_DIR.exists():
+        return
+    cutoff = time.time() - RETAIN_HOURS * 3600
+    for d in CKPT_DIR.iterdir():
+        if not d.is_dir() or d == keep:
+            continue
+        stamp = d / "index.json"
+        if (stamp if stamp.exists() else d).stat().st_mtime >= cutoff:
+            continue
+        try:
+            with file_lock(_lock_path(d), blocking=False):
+                shutil.rmtree(d, ignore_errors=True)
+        except BlockingIOError:
+            pass
+
+def _run_segment(kdir: Path, entries: list[dict], seg_start: datetime, end_utc: datetime,
+                 grid_center, parinit: Path | None) -> dict:
+    """[seg_start, end_utc) 한 구간 실행 (구간 전용 작업 폴더)"""
+    tag = f"{seg_start:%Y%m%d%H}_{end_utc:%Y%m%d%H}"
+    seg_hours = int((end_utc - seg_start).total_seconds() // 3600)
+    wdir = kdir / f"run_{tag}"
+    shutil.rmtree(wdir, ignore_errors=True)
+
+    write_emittimes_from_entries(entries, work_dir=wdir)
+    if parinit is not None:
+        shutil.copyfile(parinit, wdir / "PARINIT")
+    write_control_conc(seg_start, run_hours=seg_hours, grid_center=grid_center,
+                       work_dir=wdir, out_dir=kdir, out_name=f"cdump_{tag}")
+    # 덤프 간격은 구간 끝 시각이 반드시 덤프되도록 구간 길이의 약수로
+    write_setup_cfg(work_dir=wdir, pardump_hours=gcd(DUMP_HOURS, seg_hours), parinit=parinit is not None)
+    met = _met_state()
+    cdump = run_concentration(work_dir=wdir, cdump_path=kdir / f"cdump_{tag}")
+
+    if not (wdir / "PARDUMP").exists():
+        raise RuntimeError("PARDUMP not found after hycs_std run")
+
+    # 실제 도달 시각 확인: 기상이 end_utc 전에 끝나면 CDUMP/PARDUMP가 짧게 끝남
+    c_end = cdump_end_utc(cdump)
+    dumps = [t for t in _pardump_times(wdir / "PARDUMP") if seg_start < t <= end_utc]
+    reached = min(c_end, max(dumps)) if (c_end and dumps) else None
+    if reached is None or reached <= seg_start:
+        raise RuntimeError(f"hycs_std made no progress past {seg_start:%Y-%m-%d %H} UTC "
+                           f"(CDUMP end {c_end}, PARDUMP dumps {dumps})")
+    if reached < end_utc:
+        # 다음 확장은 reached의 덤프에서 시작 → CDUMP도 reached까지만 남김
+        merge_cdumps([cdump], cdump, reached)
+
+    pardump = kdir / f"pardump_{tag}"
+    shutil.move(str(wdir / "PARDUMP"), pardump)
+    shutil.rmtree(wdir, ignore_errors=True)
+
+    return {"start": seg_start.isoformat(), "end": reached.isoformat(),
+            "cdump": str(cdump), "pardump": str(pardump), "met": met}
+
+def run_concentration_warm(entries: list[dict], start_utc: datetime, run_hours: int,
+                           grid_center=None) -> tuple[Path, list[Path]]:
+    """
+    entries(EMITIMES)로 [start_utc, +run_hours) 계산.
+    이미 계산된 구간은 재사용하고, 마지막 유효 체크포인트부터 남은 시간만 hycs_std 실행.
+    반환: (요청 구간만 정확히 담은 합본 CDUMP, 사용한 구간별 CDUMP 목록(시간순))
+    """
+    end_utc = start_utc + timedelta(hours=run_hours)
+    kdir = CKPT_DIR / _chain_key(emittimes_text(entries), start_utc, grid_center)
+    _evict_stale(keep=kdir)
+
+    with file_lock(_lock_path(kdir)):
+        index = _load_index(kdir, start_utc)
+
+        # 기상이 바뀐 구간부터 폐기 (뒤 구간은 앞 구간 입자에 의존)
+        segs = index["segments"]
+        for n, seg in enumerate(segs):
+            if not (_met_still_valid(seg["met"]) and Path(seg["cdump"]).exists() and Path(seg["pardump"]).exists()):
+                for bad in segs[n:]:
+                    _drop(bad)
+                del segs[n:]
+                break
+
+        # 요청 끝까지 덮는 구간이 없으면 마지막 체크포인트부터 이어서 계산
+        used = next((segs[:n + 1] for n, seg in enumerate(segs)
+                     if datetime.fromisoformat(seg["end"]) >= end_utc), None)
+        if used is None:
+            seg_start = datetime.fromisoformat(segs[-1]["end"]) if segs else start_utc
+            parinit = Path(segs[-1]["pardump"]) if segs else None
+            segs.append(_run_segment(kdir, entries, seg_start, end_utc, grid_center, parinit))
+            used = segs
+
+        # index.json 갱신 = 최근 사용 시각 (보관 정책 기준)
+        (kdir / "index.json").write_text(json.dumps(index, indent=2))
+
+        cdumps = [Path(s["cdump"]) for s in used]
+        merged = merge_cdumps(cdumps, kdir / f"merged_{start_utc:%Y%m%d%H}_{end_utc:%Y%m%d%H}", end_utc)
+    return merged, cdumps
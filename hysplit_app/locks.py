@@ -0,0 +1,24 @@
+# app/locks.py
+"""
+프로세스 간 파일 잠금 (fcntl.flock)
+
+같은 작업 폴더를 쓰는 실행(SRM 구간 빌드, warm-start 체인 등)을 키 단위로 직렬화.
+API 워커 여러 개 / CLI 가 동시에 돌아도 잠금 파일 하나로 조정되고,
+프로세스가 죽으면 OS가 잠금을 해제한다.
+"""
+from __future__ import annotations
+import fcntl
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def file_lock(path: Path, blocking: bool = True):
+    """path 잠금 획득. blocking=False이면 이미 잠겨 있을 때 BlockingIOError"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
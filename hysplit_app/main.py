@@ -1,27 +1,60 @@
 # app/main.py
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel
-from datetime import datetime, timedelta, timezone
+from datetime import datetime
 from pathlib import Path
 from typing import Optional
 import os
 import json
-import csv
+import threading
 
 
 # our modules
 from .hysplit_runner import run_back_trajectory   # ← run_back_trajectory는 levels_m, out_name 지원 버전이어야 함
 from .scoring import prefilter_and_score
 from .simulate import (
-    write_emittimes_from_entries,
-    write_control_conc,
-    write_setup_cfg,
-    run_concentration,
+    load_sources,
+    build_emit_entries,
     _utc,
+    met_end_utc,
+    cdump_end_utc,
 )
+from .checkpoint import run_concentration_warm
+from .srm import build_srm, srm_window, screen
+from .singleflight import SingleFlight
 
 app = FastAPI(title="Odor Source Finder (HYSPLIT)")
 
+# 동일 요청(버스트) 병합: 진행 중인 실행에 붙어서 같은 결과 수신
+_flight = SingleFlight()
+
+def _flight_key(kind: str, req: BaseModel, **resolved) -> str:
+    """
+    정규화된 요청 키 — 모델 입력에 영향을 주는 필드만 사용
+      - 수용점/격자 중심: 소수 4자리(CONTROL과 같은 정밀도), z_agl_m 제외(시작고도는 levels_m)
+      - 시각: HYSPLIT이 쓰는 UTC 시(hour) + EMITIMES 날짜(로컬 date, 시뮬 포함 요청만)
+      - levels_m 정렬, 표시용 필드(top_n, out_name) 제외 → 응답에서 호출자별로 적용
+      - resolved: 요청 밖 상태로 정해지는 입력(예: top_k로 고른 소스 인덱스) — 원래 필드 대신 사용
+    """
+    d = req.model_dump(mode="json", exclude={"top_n", "out_name"})
+    if "sources" in resolved:
+        d.pop("source_ids", None)
+        d.pop("top_k", None)
+    d.update(resolved)
+    for k in ("receptor", "grid_center"):
+        if d.get(k):
+            d[k] = [round(d[k]["lat"], 4), round(d[k]["lon"], 4)]
+    t = req.complaint_time_local
+    d["complaint_time_local"] = f"{_utc(t):%Y%m%d%H}"
+    if kind != "analyze":
+        d["emit_day"] = t.date().isoformat()
+    if "levels_m" in d:
+        d["levels_m"] = sorted(float(z) for z in d["levels_m"])
+    return kind + ":" + json.dumps(d, sort_keys=True)
+
+def _coalesced(kind: str, req: BaseModel, fn, **resolved) -> tuple[dict, bool]:
+    return _flight.do(_flight_key(kind, req, **resolved), fn)
+
 # ---------- Models ----------
 
 class Receptor(BaseModel):
@@ -48,6 +81,20 @@ class SimReq(BaseModel):
     unit_rate_gps: float = 1.0
     grid_center: Receptor | None = None   # optional: center of concentration grid
 
+class SrmBuildReq(BaseModel):
+    window_start_local: datetime
+    run_hours: int = 24
+    grid_center: Receptor | None = None   # 기본: 시설 평균 위치
+    batch_size: int | None = None         # tagged run 1회당 시설 수 (기본 SRM_BATCH_SIZE)
+    workers: int | None = None            # 병렬 hycs_std 수 (기본 SRM_WORKERS)
+
+class ScreenReq(BaseModel):
+    receptor: Receptor
+    obs_time_local: datetime
+    observed_conc: float | None = None    # 관측 농도(있으면 필요 방출율 계산)
+    rates_gps: dict[int, float] | None = None  # {source idx: g/s}, 없으면 CSV rate_gps
+    top_n: int = 10
+
 class OneShotReq(AnalyzeReq):
     # AnalyzeReq(역궤적·랭킹 파라미터)를 상속하고, 시뮬레이션용 옵션 추가
     run_hours: int = 6
@@ -66,6 +113,11 @@ def healthz():
 
 @app.post("/analyze")
 def analyze(req: AnalyzeReq):
+    res, shared = _coalesced("analyze", req, lambda: _analyze(req))
+    return {"meta": res["meta"], "topN": res["ranking"][:req.top_n],
+            "tdump": res["tdump"], "saved": res["saved"], "coalesced": shared}
+
+def _analyze(req: AnalyzeReq) -> dict:
     # 경로
     work = Path(os.getenv("WORK_DIR", "/data/working"))
     out  = Path(os.getenv("OUT_DIR",  "/data/output"))
@@ -103,64 +155,66 @@ def analyze(req: AnalyzeReq):
     out.mkdir(parents=True, exist_ok=True)
     out_json = out / f"rank_{int(datetime.now().timestamp())}.json"
     out_json.write_text(
-        json.dumps({"meta": meta, "ranking": ranking[:req.top_n]}, ensure_ascii=False, indent=2)
+        json.dumps({"meta": meta, "ranking": ranking}, ensure_ascii=False, indent=2)
     )
 
-    return {"meta": meta, "topN": ranking[:req.top_n], "tdump": str(tdump_path), "saved": str(out_json)}
+    return {"meta": meta, "ranking": ranking, "tdump": str(tdump_path), "saved": str(out_json)}
 
 # ---------- Simulate: forward concentration (hycs_std) ----------
 
 @app.post("/simulate")
 def simulate(req: SimReq):
     cfg  = Path(os.getenv("CONFIG_DIR", "/data/config"))
-    outd = Path(os.getenv("OUT_DIR",   "/data/output"))
     sources_csv = cfg / "sources.csv"
-
     if not sources_csv.exists():
         raise HTTPException(400, f"sources.csv not found at {sources_csv}")
 
-    # load sources.csv
-    sources = []
-    with open(sources_csv, newline='', encoding='utf-8-sig') as f:
-        r = csv.DictReader(f)
-        for i, row in enumerate(r):
-            lat = float(row.get("lat") or row.get("위도"))
-            lon = float(row.get("lon") or row.get("경도"))
-            name = (row.get("name") or row.get("시설명") or f"src_{i}").strip()
-            h = float(row.get("stack_h") or row.get("굴뚝고") or 10.0)
-            src_id = (row.get("id") or row.get("ID") or row.get("시설ID") or f"S{i + 1:04d}").strip()
-            sources.append({
-                "idx": i, "id": src_id, "name": name,
-                "lat": lat, "lon": lon, "h": h,
-                # 스케줄/방출율(없으면 기본값)
-                "rate": float(row.get("rate_gps") or 1.0),
-                "emit_start": (row.get("emit_start") or "09:00"),
-                "emit_end":   (row.get("emit_end")   or "18:00"),
-                "tz":         (row.get("tz")         or "+09:00"),
-            })
-
-    # choose sources to simulate
-    chosen = []
+    # 선택 소스를 먼저 확정(top_k → 최신 랭킹의 인덱스) → 병합 키에 실제 소스 목록 사용
+    sources = load_sources(sources_csv)
+    chosen_idx = _choose_sources(req, sources)
+    res, shared = _coalesced("simulate", req, lambda: _simulate(req, sources, chosen_idx),
+                             sources=chosen_idx)
+    return {**res, "coalesced": shared}
+
+def _choose_sources(req: SimReq, sources: list[dict]) -> list[int]:
+    outd = Path(os.getenv("OUT_DIR", "/data/output"))
     if req.source_ids:
         for i in req.source_ids:
             if i < 0 or i >= len(sources):
                 raise HTTPException(400, f"source index {i} out of range (0..{len(sources)-1})")
-            chosen.append(sources[i])
-    elif req.top_k:
+        return list(req.source_ids)
+    if req.top_k:
         rank_files = sorted(outd.glob("rank_*.json"))
         if not rank_files:
             raise HTTPException(400, "No rank_*.json found. Run /analyze first or pass source_ids.")
         last = json.loads(rank_files[-1].read_text())
         names_in_rank = [item["name"] for item in last.get("ranking", [])][:req.top_k]
+        chosen = []
         for nm in names_in_rank:
             for s in sources:
                 if s["name"] == nm:
-                    chosen.append(s)
+                    chosen.append(s["idx"])
                     break
         if not chosen:
             raise HTTPException(400, "No sources matched the latest ranking by name.")
-    else:
-        raise HTTPException(400, "Provide either 'source_ids' or 'top_k'.")
+        return chosen
+    raise HTTPException(400, "Provide either 'source_ids' or 'top_k'.")
+
+def _met_capped_hours(start_utc, run_hours: int) -> int:
+    """
+    run_hours를 ARLDATA.BIN 마지막 시각까지로 제한.
+    기상 끝 시각을 못 읽으면 그대로 두고, 모델이 일찍 끝나면 warm-start가 실제 도달 시각까지만 기록.
+    """
+    met_end = met_end_utc()
+    if met_end is None:
+        return run_hours
+    hours_avail = int((met_end - start_utc).total_seconds() // 3600)
+    if hours_avail < 1:
+        raise HTTPException(400, f"ARL met ends at {met_end:%Y-%m-%d %H}Z, before run start {start_utc:%Y-%m-%d %H}Z")
+    return min(run_hours, hours_avail)
+
+def _simulate(req: SimReq, sources: list[dict], chosen_idx: list[int]) -> dict:
+    chosen = [sources[i] for i in chosen_idx]
 
     # species id 매핑(응답용)
     species_map = []
@@ -175,59 +229,121 @@ def simulate(req: SimReq):
         })
 
     # --- CSV의 로컬 시각을 UTC로 변환해 EMITIMES entries 구성 ---
-    def _to_utc_on_day(day, hhmm, tzstr):
-        h, m = map(int, hhmm.split(":"))
-        sign = 1 if tzstr[0] == '+' else -1
-        oh, om = map(int, tzstr[1:].split(":"))
-        dt_local = datetime(day.year, day.month, day.day, h, m,
-                            tzinfo=timezone(sign*timedelta(hours=oh, minutes=om)))
-        return dt_local.astimezone(timezone.utc)
-
-    day = req.complaint_time_local.date()
-
-    entries = []
-    for k, s in enumerate(chosen, start=1):
-        st_utc = _to_utc_on_day(day, s["emit_start"], s["tz"])
-        en_utc = _to_utc_on_day(day, s["emit_end"],   s["tz"])
-        dur_h = max(1, int((en_utc - st_utc).total_seconds() // 3600))
-        entries.append({
-            "species": k,
-            "id": s["id"],
-            "name": s["name"],
-            "lat": s["lat"], "lon": s["lon"], "h": s["h"],
-            "rate": s["rate"],
-            "start_utc": st_utc, "end_utc": en_utc, "dur_h": dur_h,
-        })
+    entries = build_emit_entries(chosen, req.complaint_time_local.date())
 
     head_start = min(e["start_utc"] for e in entries)
     head_end   = max(e["end_utc"]   for e in entries)
     auto_run_hours = max(1, int((head_end - head_start).total_seconds() // 3600))
 
-    # HYSPLIT 입력 파일 생성
-    write_emittimes_from_entries(entries)
-
     center_lat = (req.grid_center.lat if req.grid_center else chosen[0]["lat"])
     center_lon = (req.grid_center.lon if req.grid_center else chosen[0]["lon"])
     control_start_utc = head_start
 
-    # TIME_FIX(LATER)
-    max_hours_from_met = 5  # ARLDATA.BIN 커버 범위 (예: 0~5시)
-    run_hours_final = min(max(req.run_hours, auto_run_hours), max_hours_from_met)
-    write_control_conc(control_start_utc, run_hours=run_hours_final, grid_center=(center_lat, center_lon))
-
-    write_setup_cfg()
+    # 기상 파일이 덮는 시간까지만 (기상이 덧붙으면 다음 요청에서 체인이 이어짐)
+    run_hours_final = _met_capped_hours(control_start_utc, max(req.run_hours, auto_run_hours))
 
-    # run concentration model
-    cdump_path = run_concentration()
+    # run concentration model (이전 실행의 PARDUMP가 있으면 늘어난 시간만 계산)
+    cdump_path, cdumps = run_concentration_warm(entries, control_start_utc, run_hours=run_hours_final,
+                                                grid_center=(center_lat, center_lon))
 
+    end = cdump_end_utc(cdump_path)
     return {
         "species_map": species_map,
-        "cdump": str(cdump_path),
+        "cdump": str(cdump_path),                       # 요청 구간 전체(구간별 CDUMP 합본)
+        "cdump_end_utc": end.isoformat() if end else None,   # 실제 계산된 끝 시각
+        "cdump_segments": [str(p) for p in cdumps],
         "hint": "Use species_map to separate source-specific contributions from CDUMP.",
     }
 
+# ---------- SRM: unit-emission source-receptor matrix / screening ----------
+
+# 빌드 작업 상태 (이 프로세스에서 시작한 것; 다른 프로세스/CLI와는 구간 잠금으로 조정)
+_srm_jobs: dict[str, dict] = {}
+_srm_jobs_lock = threading.Lock()
+
+def _srm_job(window: str, req: SrmBuildReq, center):
+    try:
+        path = build_srm(
+            req.window_start_local,
+            run_hours=req.run_hours,
+            grid_center=center,
+            batch_size=req.batch_size,
+            workers=req.workers,
+        )
+        _srm_jobs[window] = {"status": "done", "srm": str(path)}
+    except BlockingIOError:
+        _srm_jobs[window] = {"status": "failed", "error": f"SRM window {window} is being built elsewhere"}
+    except Exception as e:
+        _srm_jobs[window] = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+
+@app.post("/srm/build", status_code=202)
+def srm_build(req: SrmBuildReq, background: BackgroundTasks):
+    """
+    오프라인 단계: 기상 구간별 단위방출 SRM 생성 (tagged run 배치 병렬 실행)
+    백그라운드 작업으로 시작만 하고 즉시 반환 → GET /srm/build/{window} 로 상태 확인
+    (cron 등에서는 python -m hysplit_app.srm 사용)
+    """
+    if req.run_hours < 1:
+        raise HTTPException(400, "run_hours must be >= 1")
+    if not (Path(os.getenv("CONFIG_DIR", "/data/config")) / "sources.csv").exists():
+        raise HTTPException(400, "sources.csv not found")
+    window = srm_window(req.window_start_local, req.run_hours)
+    with _srm_jobs_lock:
+        if _srm_jobs.get(window, {}).get("status") == "running":
+            raise HTTPException(409, f"SRM window {window} is already being built")
+        _srm_jobs[window] = {"status": "running"}
+    center = (req.grid_center.lat, req.grid_center.lon) if req.grid_center else None
+    background.add_task(_srm_job, window, req, center)
+    return {"window": window, "status": "running"}
+
+@app.get("/srm/build/{window}")
+def srm_build_status(window: str):
+    if window not in _srm_jobs:
+        raise HTTPException(404, f"No SRM build job for {window}")
+    return {"window": window, **_srm_jobs[window]}
+
+@app.post("/screen")
+def screen_sources(req: ScreenReq):
+    """SRM 행렬-벡터 곱으로 후보 시설 즉시 스크리닝 (확정은 /simulate 로)"""
+    try:
+        res = screen(
+            receptor_lat=req.receptor.lat,
+            receptor_lon=req.receptor.lon,
+            z_agl_m=req.receptor.z_agl_m,
+            obs_time_local=req.obs_time_local,
+            observed=req.observed_conc,
+            rates=req.rates_gps,
+        )
+    except LookupError as e:
+        raise HTTPException(404, str(e))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    res["candidates"] = res["candidates"][:req.top_n]
+    return res
+
 @app.post("/analyze_and_simulate")
 def analyze_and_simulate(req: OneShotReq):
+    """
+    동일 요청(수용점/UTC 시각/고도/lookback/선택 소스 등)이 진행 중이면 그 실행 결과를 공유
+    """
+    res, shared = _coalesced("analyze_and_simulate", req, lambda: _analyze_and_simulate(req))
+
+    # --- 5) 응답/저장 (top_n은 호출자별) ---
+    result = {
+        "analyze": {
+            "tdumps": res["analyze"]["tdumps"],
+            "meta": res["analyze"]["meta"],
+            "ranking_top": res["analyze"]["ranking"][:req.top_n],
+        },
+        "simulate": res["simulate"],
+        "saved": res["saved"],
+    }
+    out = Path(os.getenv("OUT_DIR", "/data/output"))
+    pipe_json = out / f"pipeline_{int(datetime.now().timestamp())}.json"
+    pipe_json.write_text(json.dumps(result, ensure_ascii=False, indent=2))
+    return {**result, "coalesced": shared}
+
+def _analyze_and_simulate(req: OneShotReq) -> dict:
     """
     1) 역궤적 실행(여러 시작고도 한 번에, out_name 지정 가능)
     2) 궤적 기반 후보 소스 랭킹 산출
@@ -281,26 +397,13 @@ def analyze_and_simulate(req: OneShotReq):
 
     # --- 4) 시뮬레이션 (선택) ---
     cdump_path: str | None = None
+    cdump_segments: list[str] | None = None
+    cdump_end: str | None = None
     species_map: list[dict] | None = None
 
     if chosen_idx:
         # sources.csv 읽기 (스케줄/방출율 포함)
-        src_rows: list[dict] = []
-        with open(sources_csv, newline="", encoding="utf-8-sig") as f:
-            r = csv.DictReader(f)
-            for i, row in enumerate(r):
-                src_rows.append({
-                    "idx": i,
-                    "id": (row.get("id") or row.get("ID") or row.get("시설ID") or f"S{i+1:04d}").strip(),
-                    "name": (row.get("name") or row.get("시설명") or f"src_{i}").strip(),
-                    "lat": float(row.get("lat") or row.get("위도")),
-                    "lon": float(row.get("lon") or row.get("경도")),
-                    "h":  float(row.get("stack_h") or row.get("굴뚝고") or 10.0),
-                    "rate": float(row.get("rate_gps") or 1.0),
-                    "emit_start": (row.get("emit_start") or "09:00"),
-                    "emit_end":   (row.get("emit_end")   or "18:00"),
-                    "tz":         (row.get("tz")         or "+09:00"),
-                })
+        src_rows = load_sources(sources_csv)
 
         # 인덱스로 선택
         try:
@@ -322,31 +425,7 @@ def analyze_and_simulate(req: OneShotReq):
         ]
 
         # --- entries 구성: CSV 로컬 시각을 UTC로 변환 ---
-        def _to_utc_on_day(day, hhmm, tzstr):
-            h, m = map(int, hhmm.split(":"))
-            sign = 1 if tzstr[0] == "+" else -1
-            oh, om = map(int, tzstr[1:].split(":"))
-            dt_local = datetime(day.year, day.month, day.day, h, m,
-                                tzinfo=timezone(sign * timedelta(hours=oh, minutes=om)))
-            return dt_local.astimezone(timezone.utc)
-
-        day = req.complaint_time_local.date()
-        entries: list[dict] = []
-        for k, s in enumerate(pick, start=1):
-            st_utc = _to_utc_on_day(day, s["emit_start"], s["tz"])
-            en_utc = _to_utc_on_day(day, s["emit_end"],   s["tz"])
-            dur_h  = max(1, int((en_utc - st_utc).total_seconds() // 3600))
-            entries.append({
-                "species": k,
-                "id": s["id"],
-                "name": s["name"],
-                "lat": s["lat"], "lon": s["lon"], "h": s["h"],
-                "rate": s["rate"],
-                "start_utc": st_utc, "end_utc": en_utc, "dur_h": dur_h,
-            })
-
-        # EMITIMES 작성
-        write_emittimes_from_entries(entries)
+        entries = build_emit_entries(pick, req.complaint_time_local.date())
 
         # CONTROL: 헤더 시작/길이 자동
         head_start = min(e["start_utc"] for e in entries)
@@ -356,30 +435,26 @@ def analyze_and_simulate(req: OneShotReq):
         center_lat = (req.grid_center.lat if req.grid_center else pick[0]["lat"])
         center_lon = (req.grid_center.lon if req.grid_center else pick[0]["lon"])
 
-        write_control_conc(
+        # EMITIMES/CONTROL/SETUP + 실행 (warm-start: 이미 계산된 구간은 재사용)
+        merged, cdumps = run_concentration_warm(
+            entries,
             head_start,
-            run_hours=max(req.run_hours, auto_run_hours),
+            run_hours=_met_capped_hours(head_start, max(req.run_hours, auto_run_hours)),
             grid_center=(center_lat, center_lon),
         )
+        cdump_path = str(merged)
+        end = cdump_end_utc(merged)
+        cdump_end = end.isoformat() if end else None
+        cdump_segments = [str(p) for p in cdumps]
 
-        # SETUP + 실행
-        write_setup_cfg()
-        cdump_path = str(run_concentration())
-
-    # --- 5) 응답/저장 ---
-    result = {
-        "analyze": {
-            "tdumps": tdumps,
-            "meta": meta,
-            "ranking_top": ranking[:req.top_n],
-        },
+    return {
+        "analyze": {"tdumps": tdumps, "meta": meta, "ranking": ranking},
         "simulate": {
             "used_source_indices": chosen_idx,
             "species_map": species_map,
             "cdump": cdump_path,
+            "cdump_end_utc": cdump_end,
+            "cdump_segments": cdump_segments,
         },
         "saved": str(rank_json),
     }
-    pipe_json = out / f"pipeline_{int(datetime.now().timestamp())}.json"
-    pipe_json.write_text(json.dumps(result, ensure_ascii=False, indent=2))
-    return result
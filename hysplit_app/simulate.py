@@ -1,7 +1,11 @@
 # app/simulate.py
 from __future__ import annotations
 import os
+import re
+import csv
+import struct
 import subprocess
+import threading
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
 from typing import Iterable
@@ -32,14 +36,40 @@ def _find_arl_files() -> list[str]:
         raise RuntimeError(f"No ARL files (*.BIN) under {MET_DIR}")
     return mets
 
-def _ensure_bdyfiles():
+def met_end_utc(name: str = "ARLDATA.BIN") -> datetime | None:
+    """
+    ARL 파일의 마지막 유효시각(UTC). 첫 INDX 레코드 헤더의 NX/NY로 레코드 길이(50+NX*NY)를
+    구하고 각 레코드 라벨(YYMMDDHH...변수명)에서 INDX 레코드 시각을 읽음.
+    형식을 해석할 수 없으면 None
+    """
+    path = MET_DIR / name
+    try:
+        with open(path, "rb") as f:
+            head = f.read(50 + 108)
+            if head[14:18] != b"INDX":
+                return None
+            nx, ny = int(head[50 + 93:50 + 96]), int(head[50 + 96:50 + 99])
+            reclen = 50 + nx * ny
+            last = None
+            for off in range(0, path.stat().st_size - reclen + 1, reclen):
+                f.seek(off)
+                label = f.read(50)
+                if label[14:18] == b"INDX":
+                    yy, mm, dd, hh = (int(label[i:i + 2]) for i in (0, 2, 4, 6))
+                    last = datetime(2000 + yy, mm, dd, hh, tzinfo=timezone.utc)
+            return last
+    except (OSError, ValueError):
+        return None
+
+def _ensure_bdyfiles(work_dir: Path | None = None):
     """hycs_std는 작업 디렉터리에서 ASCDATA.CFG를 찾음 → conc 폴더에 심볼릭 링크(또는 복사) 보장"""
-    CONC_DIR.mkdir(parents=True, exist_ok=True)
+    conc_dir = work_dir or CONC_DIR
+    conc_dir.mkdir(parents=True, exist_ok=True)
     asc_src = BDY_DIR / "ASCDATA.CFG"
     if not asc_src.exists():
         raise FileNotFoundError(f"ASCDATA.CFG not found at {asc_src}")
 
-    asc_dst = CONC_DIR / "ASCDATA.CFG"
+    asc_dst = conc_dir / "ASCDATA.CFG"
     if asc_dst.exists():
         return
     try:
@@ -47,8 +77,57 @@ def _ensure_bdyfiles():
     except Exception:
         asc_dst.write_text(asc_src.read_text())
 
+# ---- 소스 ----
+def load_sources(sources_csv: Path) -> list[dict]:
+    """sources.csv 읽기 (BOM/한글 헤더 대응, 스케줄/방출율 포함)"""
+    sources = []
+    with open(sources_csv, newline="", encoding="utf-8-sig") as f:
+        r = csv.DictReader(f)
+        for i, row in enumerate(r):
+            sources.append({
+                "idx": i,
+                "id": (row.get("id") or row.get("ID") or row.get("시설ID") or f"S{i+1:04d}").strip(),
+                "name": (row.get("name") or row.get("시설명") or f"src_{i}").strip(),
+                "lat": float(row.get("lat") or row.get("위도")),
+                "lon": float(row.get("lon") or row.get("경도")),
+                "h":  float(row.get("stack_h") or row.get("굴뚝고") or 10.0),
+                "rate": float(row.get("rate_gps") or 1.0),
+                "emit_start": (row.get("emit_start") or "09:00"),
+                "emit_end":   (row.get("emit_end")   or "18:00"),
+                "tz":         (row.get("tz")         or "+09:00"),
+            })
+    return sources
+
+def _to_utc_on_day(day, hhmm, tzstr):
+    h, m = map(int, hhmm.split(":"))
+    sign = 1 if tzstr[0] == "+" else -1
+    oh, om = map(int, tzstr[1:].split(":"))
+    dt_local = datetime(day.year, day.month, day.day, h, m,
+                        tzinfo=timezone(sign * timedelta(hours=oh, minutes=om)))
+    return dt_local.astimezone(timezone.utc)
+
+def build_emit_entries(sources: list[dict], day, rate: float | None = None) -> list[dict]:
+    """
+    CSV 로컬 스케줄을 UTC로 변환해 EMITIMES entries 구성 (species = 1..N, 입력 순서)
+    rate: 지정하면 모든 소스에 동일 방출율(예: 단위방출 1.0 g/s)
+    """
+    entries = []
+    for k, s in enumerate(sources, start=1):
+        st_utc = _to_utc_on_day(day, s["emit_start"], s["tz"])
+        en_utc = _to_utc_on_day(day, s["emit_end"],   s["tz"])
+        dur_h  = max(1, int((en_utc - st_utc).total_seconds() // 3600))
+        entries.append({
+            "species": k,
+            "id": s["id"],
+            "name": s["name"],
+            "lat": s["lat"], "lon": s["lon"], "h": s["h"],
+            "rate": s["rate"] if rate is None else rate,
+            "start_utc": st_utc, "end_utc": en_utc, "dur_h": dur_h,
+        })
+    return entries
+
 # ---- 입력 파일 생성 ----
-def write_emittimes_from_entries(entries: list[dict]) -> Path:
+def emittimes_text(entries: list[dict], pollutants: int | None = None) -> str:
     """
     entries: 각 소스(=species)에 대해
       {
@@ -57,8 +136,9 @@ def write_emittimes_from_entries(entries: list[dict]) -> Path:
         "rate": float,
         "start_utc": datetime, "end_utc": datetime, "dur_h": int
       }
+    pollutants: CONTROL에 오염물질을 N개 선언한 tagged run이면 N.
+                각 entry를 오염물질 1..N 레코드로 펼치고 자기 species에만 방출율 부여
     """
-    CONC_DIR.mkdir(parents=True, exist_ok=True)
     if not entries:
         raise ValueError("EMITIMES entries is empty")
 
@@ -72,26 +152,54 @@ def write_emittimes_from_entries(entries: list[dict]) -> Path:
     lines.append("1")  # 1-hour resolution
 
     for e in entries:
-        lines.append(
-            f'{e["start_utc"]:%Y %m %d %H} {int(e["dur_h"]):3d} '
-            f'{float(e["lat"]):8.3f} {float(e["lon"]):9.3f} {float(e["h"]):6.1f} '
-            f'{float(e["rate"]):8.3f} 0.0 0.0 0.0 0.0 0.0 {int(e["species"]):3d}'
-        )
-
-    p = CONC_DIR / "EMITIMES"
-    p.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        species = range(1, pollutants + 1) if pollutants else [int(e["species"])]
+        for sp in species:
+            rate = float(e["rate"]) if sp == int(e["species"]) else 0.0
+            lines.append(
+                f'{e["start_utc"]:%Y %m %d %H} {int(e["dur_h"]):3d} '
+                f'{float(e["lat"]):8.3f} {float(e["lon"]):9.3f} {float(e["h"]):6.1f} '
+                f'{rate:8.3f} 0.0 0.0 0.0 0.0 0.0 {sp:3d}'
+            )
+    return "\n".join(lines) + "\n"
+
+def write_emittimes_from_entries(entries: list[dict], work_dir: Path | None = None,
+                                 pollutants: int | None = None) -> Path:
+    """
+    entries/pollutants: emittimes_text 참고
+    work_dir: 작업 폴더(기본 CONC_DIR; 병렬 배치 실행 시 배치별 폴더)
+    """
+    conc_dir = work_dir or CONC_DIR
+    conc_dir.mkdir(parents=True, exist_ok=True)
+    p = conc_dir / "EMITIMES"
+    p.write_text(emittimes_text(entries, pollutants), encoding="utf-8")
     return p
 
-def write_control_conc(start_utc: datetime, run_hours: int, grid_center=None) -> Path:
+def write_control_conc(start_utc: datetime, run_hours: int, grid_center=None,
+                       work_dir: Path | None = None, out_dir: Path | None = None,
+                       out_name: str = "cdump_tagged", pollutants: int = 1) -> Path:
     """
-    고정된 CONTROL 템플릿 사용 (날짜/시간만 갱신)
+    고정된 CONTROL 템플릿 사용 (날짜/시간/실행시간만 갱신)
+    grid_center: (lat, lon) 농도격자 중심. 없으면 0.0 0.0(= 첫 방출 위치)
+    pollutants: 1이면 TAGGED_RUN 하나, N이면 species별 오염물질 T001..TNNN 선언
+                (EMITIMES도 같은 N으로 작성해야 함)
     """
-    CONC_DIR.mkdir(parents=True, exist_ok=True)
+    conc_dir = work_dir or CONC_DIR
+    conc_dir.mkdir(parents=True, exist_ok=True)
+    out_dir = out_dir or OUT_DIR
+    c_lat, c_lon = grid_center if grid_center else (0.0, 0.0)
+
+    if pollutants > 1:
+        pol_ids = [f"T{k:03d}" for k in range(1, pollutants + 1)]
+    else:
+        pol_ids = ["TAGGED_RUN"]
+    pol_block = "\n".join(
+        f"{pid}\n1.0\n1.0\n{start_utc:%Y %m %d %H} 00" for pid in pol_ids
+    )
 
     txt = f"""{start_utc:%Y %m %d %H}
 1
 0.0 0.0 0.0
-12
+{int(run_hours)}
 2
 10000.0
 1
@@ -99,59 +207,110 @@ def write_control_conc(start_utc: datetime, run_hours: int, grid_center=None) ->
 ARLDATA.BIN
 1
 EMITIMES
+{len(pol_ids)}
+{pol_block}
 1
-TAGGED_RUN
-1.0
-1.0
-{start_utc:%Y %m %d %H} 00
-1
-0.0 0.0
+{float(c_lat)} {float(c_lon)}
 0.1 0.1
 4.0 4.0
-{OUT_DIR}/
-cdump_tagged
+{out_dir}/
+{out_name}
 1
 100
 {start_utc:%Y %m %d %H} 00
 {(start_utc + timedelta(hours=run_hours)):%Y %m %d %H} 00
 00 01 00
 """
-    path = CONC_DIR / "CONTROL"
+    path = conc_dir / "CONTROL"
     path.write_text(txt.strip() + "\n", encoding="utf-8")
     return path
 
-def write_setup_cfg() -> Path:
-    CONC_DIR.mkdir(parents=True, exist_ok=True)
-    tmpl = CFG_DIR / "SETUP.CFG"
-    if tmpl.exists():
-        (CONC_DIR / "SETUP.CFG").write_text(tmpl.read_text(), encoding="utf-8")
-        return CONC_DIR / "SETUP.CFG"
-
-    txt = """&SETUP
+SETUP_DEFAULT = """&SETUP
 efile = 'EMITIMES',
 ichem = 10,
 cpack = 1,
 numpar = 50000,
 /
 """
-    (CONC_DIR / "SETUP.CFG").write_text(txt, encoding="utf-8")
-    return CONC_DIR / "SETUP.CFG"
+
+def setup_base_text() -> str:
+    """CONFIG_DIR/SETUP.CFG 템플릿(있으면) 또는 기본 SETUP"""
+    tmpl = CFG_DIR / "SETUP.CFG"
+    return tmpl.read_text() if tmpl.exists() else SETUP_DEFAULT
+
+_NML_END = ("/", "&END", "$END")
+_NML_ASSIGN = re.compile(r"""\s*(\w+)\s*=\s*('[^']*'|"[^"]*"|[^,]*?)\s*(,|$)""")
+
+def _set_namelist(txt: str, values: dict[str, str]) -> str:
+    """
+    namelist 키 설정: 기존 같은 키는 제거(대소문자 무시) 후 종료줄('/' 또는 &END) 앞에 추가
+    """
+    lines = txt.splitlines()
+    end = next((n for n in range(len(lines) - 1, -1, -1) if lines[n].strip().upper() in _NML_END), None)
+    if end is None:
+        raise ValueError("SETUP.CFG: namelist terminator ('/' or &END on its own line) not found")
+
+    keys = {k.lower() for k in values}
+    for n in range(end):
+        line, pos, kept = lines[n], 0, []
+        while pos < len(line):
+            m = _NML_ASSIGN.match(line, pos)
+            if not m or m.end() == pos:
+                break
+            if m.group(1).lower() not in keys:
+                kept.append(m.group(0).strip())
+            pos = m.end()
+        else:
+            lines[n] = " ".join(kept)   # 대입문만 있는 줄 → 남길 대입문만 다시 조립
+
+    body = [ln for ln in lines[:end] if ln.strip()]
+    body += [f"{k} = {v}," for k, v in values.items()]
+    return "\n".join(body + lines[end:]) + "\n"
+
+def write_setup_cfg(work_dir: Path | None = None, pardump_hours: int | None = None,
+                    parinit: bool = False) -> Path:
+    """
+    pardump_hours: N시간마다 입자 덤프(PARDUMP) 기록 (ndump/ncycl)
+    parinit: 작업 폴더의 PARINIT에서 입자 초기화 (ninit=1, 시작시각이 일치하는 덤프 사용)
+    템플릿에 같은 키가 있으면 덮어씀
+    """
+    conc_dir = work_dir or CONC_DIR
+    conc_dir.mkdir(parents=True, exist_ok=True)
+    txt = setup_base_text()
+
+    values = {}
+    if pardump_hours:
+        values.update(ndump=str(int(pardump_hours)), ncycl=str(int(pardump_hours)), poutf="'PARDUMP'")
+    if parinit:
+        values.update(ninit="1", pinpf="'PARINIT'")
+    if values:
+        txt = _set_namelist(txt, values)
+
+    (conc_dir / "SETUP.CFG").write_text(txt, encoding="utf-8")
+    return conc_dir / "SETUP.CFG"
 
 # ---- 실행 ----
-def run_concentration() -> Path:
-    CONC_DIR.mkdir(parents=True, exist_ok=True)
-    _ensure_bdyfiles()
+def run_concentration(work_dir: Path | None = None, cdump_path: Path | None = None) -> Path:
+    """
+    hycs_std 실행. work_dir/cdump_path를 주면 해당 폴더에서 실행하고
+    CONTROL에 지정한 cdump_path 산출물을 반환 (병렬 배치용)
+    """
+    conc_dir = work_dir or CONC_DIR
+    conc_dir.mkdir(parents=True, exist_ok=True)
+    _ensure_bdyfiles(conc_dir)
 
     # 이전 산출물 정리
-    try: (OUT_DIR / "CDUMP").unlink()
-    except FileNotFoundError: pass
-    try: (CONC_DIR / "MESSAGE").unlink()
-    except FileNotFoundError: pass
-    try: (CONC_DIR / "WARNING").unlink()
-    except FileNotFoundError: pass
+    for p in [cdump_path or OUT_DIR / "CDUMP", conc_dir / "MESSAGE", conc_dir / "WARNING"]:
+        try: p.unlink()
+        except FileNotFoundError: pass
 
     # ★ 여기! 실행 디렉터리를 conc 로
-    subprocess.run([str(HYCS)], cwd=str(CONC_DIR), check=True)
+    subprocess.run([str(HYCS)], cwd=str(conc_dir), check=True)
+
+    if cdump_path is not None:
+        if cdump_path.exists():
+            return cdump_path
+        raise RuntimeError(f"{cdump_path} not found after hycs_std run")
 
     cdump_out = OUT_DIR / "CDUMP"
     if cdump_out.exists():
@@ -165,3 +324,110 @@ def run_concentration() -> Path:
 # ---- (선택) 간단 파서 ----
 def parse_cdump_species(cdump_path: Path) -> dict:
     return {"path": str(cdump_path)}
+
+def _fortran_records(path: Path):
+    """Fortran unformatted(sequential, big-endian) 레코드 순회"""
+    data = path.read_bytes()
+    pos = 0
+    while pos < len(data):
+        (n,) = struct.unpack_from(">i", data, pos)
+        yield data[pos + 4:pos + 4 + n]
+        pos += n + 8
+
+def _cdump_time(rec: bytes) -> datetime:
+    y, m, d, h, mi, _fh = struct.unpack_from(">6i", rec)
+    if y < 100:
+        y += 2000
+    return datetime(y, m, d, h, mi, tzinfo=timezone.utc)
+
+def read_cdump(cdump_path: Path) -> dict:
+    """
+    HYSPLIT 이진 CDUMP 파서 (packed/unpacked 모두)
+    반환:
+      {
+        "grid": {"nlat", "nlon", "dlat", "dlon", "lat0", "lon0"},   # lat0/lon0 = 좌하단 격자 중심
+        "levels": [m agl, ...], "pollutants": ["ID", ...],
+        "periods": [{"start": dt, "stop": dt,
+                     "conc": {(pol_idx, lev_idx): {(i, j): conc}}}]    # i=lon, j=lat (1-based)
+      }
+    """
+    recs = _fortran_records(Path(cdump_path))
+
+    head = next(recs)
+    nloc, packing = struct.unpack_from(">2i", head, 4 + 5 * 4)
+    for _ in range(nloc):
+        next(recs)
+    nlat, nlon, dlat, dlon, lat0, lon0 = struct.unpack_from(">2i4f", next(recs))
+    rec = next(recs)
+    (nlev,) = struct.unpack_from(">i", rec)
+    levels = list(struct.unpack_from(f">{nlev}i", rec, 4))
+    rec = next(recs)
+    (npol,) = struct.unpack_from(">i", rec)
+    pollutants = [rec[4 + 4 * k:8 + 4 * k].decode("ascii", "ignore").strip() for k in range(npol)]
+
+    periods = []
+    for rec in recs:
+        start = _cdump_time(rec)
+        stop = _cdump_time(next(recs))
+        conc = {}
+        for p in range(npol):
+            for k in range(nlev):
+                rec = next(recs)
+                cells = {}
+                if packing == 1:
+                    (n,) = struct.unpack_from(">i", rec, 8)
+                    for m in range(n):
+                        i, j, c = struct.unpack_from(">2hf", rec, 12 + 10 * m)
+                        if c:
+                            cells[(i, j)] = c
+                else:
+                    vals = struct.unpack_from(f">{nlon * nlat}f", rec, 8)
+                    for idx, c in enumerate(vals):   # conc(nlon, nlat), i가 가장 빠름
+                        if c:
+                            cells[(idx % nlon + 1, idx // nlon + 1)] = c
+                conc[(p, k)] = cells
+        periods.append({"start": start, "stop": stop, "conc": conc})
+
+    return {
+        "grid": {"nlat": nlat, "nlon": nlon, "dlat": dlat, "dlon": dlon, "lat0": lat0, "lon0": lon0},
+        "levels": levels,
+        "pollutants": pollutants,
+        "periods": periods,
+    }
+
+def _cdump_layout(recs: list[bytes]) -> tuple[int, int]:
+    """(헤더 레코드 수, 시간 구간당 레코드 수)"""
+    (nloc,) = struct.unpack_from(">i", recs[0], 4 + 5 * 4)
+    nhead = 1 + nloc + 3
+    (nlev,) = struct.unpack_from(">i", recs[nhead - 2])
+    (npol,) = struct.unpack_from(">i", recs[nhead - 1])
+    return nhead, 2 + npol * nlev
+
+def merge_cdumps(paths: list[Path], out_path: Path, end_utc: datetime | None = None) -> Path:
+    """
+    같은 격자/오염물질/고도의 구간별 CDUMP를 하나로 이어붙임
+    (첫 파일 헤더 + 각 파일의 시간 구간 레코드, 끝 시각이 end_utc 이후인 구간은 제외)
+    """
+    out = bytearray()
+    for n, path in enumerate(paths):
+        recs = list(_fortran_records(Path(path)))
+        nhead, per = _cdump_layout(recs)
+        keep = recs[:nhead] if n == 0 else []
+        for t in range(nhead, len(recs), per):
+            if end_utc is None or _cdump_time(recs[t + 1]) <= end_utc:
+                keep += recs[t:t + per]
+        for rec in keep:
+            out += struct.pack(">i", len(rec)) + rec + struct.pack(">i", len(rec))
+    # 다른 요청이 읽는 중일 수 있으므로 임시 파일에 쓰고 교체
+    tmp = out_path.with_name(f"{out_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(bytes(out))
+    tmp.replace(out_path)
+    return out_path
+
+def cdump_end_utc(cdump_path: Path) -> datetime | None:
+    """CDUMP 마지막 시간 구간의 끝 시각 (구간이 없으면 None)"""
+    recs = list(_fortran_records(Path(cdump_path)))
+    nhead, per = _cdump_layout(recs)
+    if len(recs) < nhead + per:
+        return None
+    return _cdump_time(recs[nhead + (len(recs) - nhead) // per * per - per + 1])
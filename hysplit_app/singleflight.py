@@ -0,0 +1,48 @@
+# app/singleflight.py
+"""
+동일 요청 single-flight 병합
+
+키가 같은 요청이 실행 중이면 새로 실행하지 않고 진행 중인 실행에 붙어서
+같은 결과(또는 같은 예외)를 받는다. 실행이 끝나면 키는 즉시 해제(결과 캐시 아님).
+FastAPI의 동기 엔드포인트는 스레드풀에서 돌기 때문에 threading 기반.
+"""
+from __future__ import annotations
+import threading
+from typing import Callable, Any
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, _Call] = {}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> tuple[Any, bool]:
+        """fn() 결과와 공유 여부(True = 진행 중이던 실행에 붙음)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
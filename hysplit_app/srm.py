@@ -0,0 +1,261 @@
+# app/srm.py
+"""
+단위방출 소스-수용점 행렬(SRM)
+
+농도는 방출율에 선형 → 기상 구간(window)마다 모든 시설을 1 g/s로 방출한
+tagged run 결과를 희소행렬로 저장해 두고, 스크리닝은 행렬-벡터 곱으로 즉시 응답.
+  행(row) = (시간 t, 고도 k, 격자 j, i)  /  열(col) = sources.csv 인덱스
+"""
+from __future__ import annotations
+import os
+import re
+import json
+import gzip
+import bisect
+import argparse
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .simulate import (
+    WORK_ROOT, OUT_DIR, MET_DIR, CFG_DIR,
+    load_sources,
+    build_emit_entries,
+    write_emittimes_from_entries,
+    write_control_conc,
+    write_setup_cfg,
+    run_concentration,
+    read_cdump,
+    _utc,
+)
+from .locks import file_lock
+
+SRM_WORK_DIR = WORK_ROOT / "srm"
+SRM_DIR      = OUT_DIR / "srm"
+BATCH_SIZE   = int(os.getenv("SRM_BATCH_SIZE", "20"))   # tagged run 1회당 시설(species) 수
+MAX_WORKERS  = int(os.getenv("SRM_WORKERS", str(os.cpu_count() or 1)))
+CACHE_SIZE   = int(os.getenv("SRM_CACHE_SIZE", "4"))    # 메모리에 올려둘 SRM 수 (LRU)
+
+_cache: OrderedDict[str, tuple[float, dict]] = OrderedDict()   # path -> (mtime, srm)
+_NAME = re.compile(r"srm_(\d{10})_(\d+)h\.json\.gz$")
+
+def _window_key(start_utc: datetime, run_hours: int) -> str:
+    return f"{start_utc:%Y%m%d%H}_{int(run_hours)}h"
+
+def srm_window(window_start_local: datetime, run_hours: int) -> str:
+    """구간 키 (결과 파일명 srm_<window>.json.gz / 잠금 단위)"""
+    return _window_key(_utc(window_start_local), run_hours)
+
+def _met_stamp() -> list[list]:
+    """기상 파일 지문(이름/크기/수정시각) → 기상 교체 시 행렬 무효화 판단용"""
+    return [[p.name, p.stat().st_size, int(p.stat().st_mtime)] for p in sorted(MET_DIR.glob("*.BIN"))]
+
+def _window_days(window_start_local: datetime, run_hours: int) -> list:
+    """구간이 걸친 로컬 날짜 전부 (자정을 넘는 구간도 매일 스케줄대로 방출)"""
+    first = window_start_local.date()
+    last = (window_start_local + timedelta(hours=run_hours)).date()
+    return [first + timedelta(days=d) for d in range((last - first).days + 1)]
+
+def _run_batch(b: int, batch: list[dict], days: list, start_utc: datetime, run_hours: int,
+               grid_center: tuple[float, float], work: Path) -> dict:
+    bdir = work / f"b{b:03d}"
+    entries = [e for day in days for e in build_emit_entries(batch, day, rate=1.0)]
+    # 배치 내 시설마다 오염물질 하나씩 선언 → CDUMP 오염물질 순서 = 배치 순서
+    write_emittimes_from_entries(entries, work_dir=bdir, pollutants=len(batch))
+    write_control_conc(start_utc, run_hours=run_hours, grid_center=grid_center,
+                       work_dir=bdir, out_dir=bdir, out_name="cdump", pollutants=len(batch))
+    write_setup_cfg(work_dir=bdir)
+    return read_cdump(run_concentration(work_dir=bdir, cdump_path=bdir / "cdump"))
+
+def build_srm(window_start_local: datetime, run_hours: int,
+              grid_center: tuple[float, float] | None = None,
+              batch_size: int | None = None, workers: int | None = None) -> Path:
+    """
+    기상 구간 [window_start, +run_hours) 의 SRM 생성 → OUT_DIR/srm/srm_<window>.json.gz
+    - 시설을 batch_size개씩 묶어 tagged run (species 1..N = 배치 내 순서)
+    - 배치별 작업 폴더에서 hycs_std 병렬 실행
+    - 모든 배치가 같은 격자를 쓰도록 grid_center 고정(기본: 시설 평균 위치)
+    - 같은 구간을 동시에 빌드하면 BlockingIOError (구간별 잠금)
+    """
+    if run_hours < 1:
+        raise ValueError("run_hours must be >= 1")
+    sources_csv = CFG_DIR / "sources.csv"
+    if not sources_csv.exists():
+        raise FileNotFoundError(f"sources.csv not found at {sources_csv}")
+    sources = load_sources(sources_csv)
+    if not sources:
+        raise ValueError("sources.csv is empty")
+
+    start_utc = _utc(window_start_local)
+    days = _window_days(window_start_local, run_hours)
+    if grid_center is None:
+        grid_center = (sum(s["lat"] for s in sources) / len(sources),
+                       sum(s["lon"] for s in sources) / len(sources))
+
+    size = max(1, batch_size or BATCH_SIZE)
+    batches = [sources[i:i + size] for i in range(0, len(sources), size)]
+    key = _window_key(start_utc, run_hours)
+    work = SRM_WORK_DIR / key
+
+    with file_lock(SRM_WORK_DIR / f"{key}.lock", blocking=False):
+        with ThreadPoolExecutor(max_workers=max(1, workers or MAX_WORKERS)) as ex:
+            futs = [ex.submit(_run_batch, b, batch, days, start_utc, run_hours, grid_center, work)
+                    for b, batch in enumerate(batches)]
+            results = [f.result() for f in futs]
+        return _save_srm(key, start_utc, run_hours, grid_center, sources, batches, results)
+
+def _save_srm(key: str, start_utc: datetime, run_hours: int, grid_center: tuple[float, float],
+              sources: list[dict], batches: list[list[dict]], results: list[dict]) -> Path:
+    """배치별 CDUMP를 (row -> {col: 단위농도})로 취합해 희소 저장"""
+    # (row -> {col: 단위농도}) 취합
+    grid, levels, times = None, None, None
+    rows: dict[int, dict[int, float]] = {}
+    for batch, cd in zip(batches, results):
+        if grid is None:
+            grid, levels = cd["grid"], cd["levels"]
+            times = [[p["start"].isoformat(), p["stop"].isoformat()] for p in cd["periods"]]
+        elif cd["grid"] != grid or len(cd["periods"]) != len(times):
+            raise RuntimeError("SRM batches produced inconsistent concentration grids")
+        if len(cd["pollutants"]) != len(batch):
+            raise RuntimeError(
+                f"CDUMP has {len(cd['pollutants'])} pollutant(s) for {len(batch)} tagged sources; "
+                "check SETUP.CFG (ichem) or set SRM_BATCH_SIZE=1"
+            )
+        ncell = grid["nlat"] * grid["nlon"]
+        for t, period in enumerate(cd["periods"]):
+            for (p, k), cells in period["conc"].items():
+                col = batch[p]["idx"]
+                base = (t * len(levels) + k) * ncell
+                for (i, j), c in cells.items():
+                    rows.setdefault(base + (j - 1) * grid["nlon"] + (i - 1), {})[col] = c
+
+    # 희소(CSR, 비어있지 않은 행만) 저장
+    row_ids = sorted(rows)
+    indptr, indices, data = [0], [], []
+    for r in row_ids:
+        for col, c in sorted(rows[r].items()):
+            indices.append(col)
+            data.append(c)
+        indptr.append(len(indices))
+
+    srm = {
+        "meta": {
+            "window": key,
+            "start_utc": start_utc.isoformat(),
+            "run_hours": int(run_hours),
+            "grid": grid, "levels": levels, "times": times,
+            "grid_center": list(grid_center),
+            "met": _met_stamp(),
+            "sources": [{"idx": s["idx"], "id": s["id"], "name": s["name"],
+                         "lat": s["lat"], "lon": s["lon"], "rate": s["rate"]} for s in sources],
+            "created": datetime.now().isoformat(timespec="seconds"),
+        },
+        "rows": row_ids, "indptr": indptr, "indices": indices, "data": data,
+    }
+    SRM_DIR.mkdir(parents=True, exist_ok=True)
+    path = SRM_DIR / f"srm_{key}.json.gz"
+    tmp = path.with_suffix(".tmp")
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(srm, f, ensure_ascii=False)
+    tmp.replace(path)
+    return path
+
+def _load(path: Path) -> dict:
+    mtime = path.stat().st_mtime
+    hit = _cache.get(str(path))
+    if hit and hit[0] == mtime:
+        _cache.move_to_end(str(path))
+        return hit[1]
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        srm = json.load(f)
+    _cache[str(path)] = (mtime, srm)
+    _cache.move_to_end(str(path))
+    while len(_cache) > max(1, CACHE_SIZE):
+        _cache.popitem(last=False)
+    return srm
+
+def _covering(t_utc: datetime) -> list[Path]:
+    """파일명(srm_<YYYYMMDDHH>_<N>h)의 구간이 t_utc를 포함하는 SRM만 (최신 생성본 우선)"""
+    hits = []
+    for path in SRM_DIR.glob("srm_*.json.gz"):
+        m = _NAME.search(path.name)
+        if not m:
+            continue
+        start = datetime.strptime(m.group(1), "%Y%m%d%H").replace(tzinfo=timezone.utc)
+        if start <= t_utc < start + timedelta(hours=int(m.group(2))):
+            hits.append(path)
+    return sorted(hits, key=lambda p: p.stat().st_mtime, reverse=True)
+
+def find_srm(t_utc: datetime) -> tuple[dict, int]:
+    """t_utc가 포함된 샘플링 구간을 가진 SRM과 시간 인덱스 (최신 생성본 우선)"""
+    for path in _covering(t_utc):
+        srm = _load(path)
+        for t, (st, en) in enumerate(srm["meta"]["times"]):
+            if datetime.fromisoformat(st) <= t_utc < datetime.fromisoformat(en):
+                return srm, t
+    raise LookupError(f"No SRM covers {t_utc:%Y-%m-%d %H:%M} UTC. Build one with /srm/build first.")
+
+def screen(*, receptor_lat: float, receptor_lon: float, z_agl_m: float, obs_time_local: datetime,
+           observed: float | None = None, rates: dict[int, float] | None = None) -> dict:
+    """
+    수용점/시각의 SRM 행 × 방출율 벡터 → 시설별 기여농도
+    observed가 있으면 시설별 '관측치를 단독으로 설명하는 데 필요한 방출율'도 계산
+    rates: {source idx: g/s}, 없으면 sources.csv의 rate_gps
+    """
+    t_utc = _utc(obs_time_local)
+    srm, t = find_srm(t_utc)
+    meta, g = srm["meta"], srm["meta"]["grid"]
+
+    i = round((receptor_lon - g["lon0"]) / g["dlon"]) + 1
+    j = round((receptor_lat - g["lat0"]) / g["dlat"]) + 1
+    if not (1 <= i <= g["nlon"] and 1 <= j <= g["nlat"]):
+        raise ValueError("receptor is outside the SRM concentration grid")
+    levels = meta["levels"]
+    k = min(range(len(levels)), key=lambda n: abs(levels[n] - z_agl_m))
+    row = (t * len(levels) + k) * g["nlat"] * g["nlon"] + (j - 1) * g["nlon"] + (i - 1)
+
+    srcs = meta["sources"]
+    rate_of = {s["idx"]: s["rate"] for s in srcs}
+    if rates:
+        rate_of.update(rates)
+
+    candidates = []
+    n = bisect.bisect_left(srm["rows"], row)
+    if n < len(srm["rows"]) and srm["rows"][n] == row:
+        for pos in range(srm["indptr"][n], srm["indptr"][n + 1]):
+            col, unit = srm["indices"][pos], srm["data"][pos]
+            s = srcs[col]
+            c = unit * rate_of.get(col, 0.0)
+            item = {"idx": col, "id": s["id"], "name": s["name"],
+                    "unit_conc": unit, "rate_gps": rate_of.get(col, 0.0), "conc": c}
+            if observed:
+                item["required_rate_gps"] = observed / unit
+                item["explains_fraction"] = c / observed
+            candidates.append(item)
+    candidates.sort(key=lambda x: -x["conc"])
+
+    return {
+        "window": meta["window"],
+        "period": meta["times"][t],
+        "level_m": levels[k],
+        "cell": [i, j],
+        "stale_met": meta["met"] != _met_stamp(),
+        "predicted_total": sum(c["conc"] for c in candidates),
+        "observed": observed,
+        "candidates": candidates,
+    }
+
+
+if __name__ == "__main__":
+    # 오프라인 빌드(cron 등): python -m hysplit_app.srm --start 2026-10-19T00:00 --hours 24
+    ap = argparse.ArgumentParser(description="Build unit-emission source-receptor matrix")
+    ap.add_argument("--start", required=True, type=datetime.fromisoformat,
+                    help="window start (local; tz 없으면 KST)")
+    ap.add_argument("--hours", type=int, default=24)
+    ap.add_argument("--center", type=float, nargs=2, metavar=("LAT", "LON"))
+    ap.add_argument("--batch-size", type=int)
+    ap.add_argument("--workers", type=int)
+    a = ap.parse_args()
+    print(build_srm(a.start, a.hours, grid_center=tuple(a.center) if a.center else None,
+                    batch_size=a.batch_size, workers=a.workers))